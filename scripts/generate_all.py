@@ -1,10 +1,16 @@
+import array
+import atexit
+import mmap
+import multiprocessing
+import shutil
 import struct
-import socket
-import ipaddress
 import os
 import requests
 import datetime
 
+import ahocorasick
+import numpy as np
+
 # ==================================================
 # 配置项
 # ==================================================
@@ -35,33 +41,147 @@ ISPS = {
     "电信": "chinanet"
 }
 
+# 命中多个关键词时按字典定义顺序取第一个，与逐个 `in` 匹配的老逻辑一致
+_ISP_ORDER = {code: i for i, code in enumerate(ISPS.values())}
+_PROV_ORDER = {code: i for i, code in enumerate(PROVINCES.values())}
+
+# 运营商关键词的 GBK 字节串，用作分类前的粗筛：
+# 大部分记录不含任何运营商，先用几次字节级 `in` 把它们筛掉，
+# 命中了才值得跑自动机做省份匹配
+_ISP_GBK = tuple(isp_cn.encode('gbk') for isp_cn in ISPS)
+
+# (省份, 运营商) 分类桶的固定编号，供向量化回填使用
+_BUCKETS = [(p_code, isp_code)
+            for p_code in PROVINCES.values() for isp_code in ISPS.values()]
+_BUCKET_INDEX = {pair: i for i, pair in enumerate(_BUCKETS)}
+
+# ==================================================
+# 3. Aho-Corasick 自动机
+# 把运营商 + 省份关键词编进一个自动机，每条记录只需
+# 扫一遍位置串，替代最多 37 次 Python 级 `in` 子串查找
+# ==================================================
+def _build_automaton():
+    # 关键词预编码成 GBK，直接在数据库原始字节上匹配，
+    # 热路径不再做 GBK 解码。pyahocorasick 的 wheel 只支持 str，
+    # 所以用 latin-1 把 GBK 字节一一映射成字符后再进自动机
+    automaton = ahocorasick.Automaton()
+    for isp_cn, isp_code in ISPS.items():
+        automaton.add_word(isp_cn.encode('gbk').decode('latin-1'), ('isp', isp_code))
+    for prov_cn, prov_code in PROVINCES.items():
+        automaton.add_word(prov_cn.encode('gbk').decode('latin-1'), ('prov', prov_code))
+    automaton.make_automaton()
+    return automaton
+
+# ==================================================
+# 4. 整数 CIDR 切分
+# 直接在 u32 上做位运算切出 CIDR 块，
+# 免去每段两个 IPv4Address 对象和 summarize_address_range 的开销
+# ==================================================
+def _fmt_cidr(ip, prefix):
+    # 一个 f-string 直接产出带换行的整行，中间不再有临时 str
+    return f"{(ip >> 24) & 255}.{(ip >> 16) & 255}.{(ip >> 8) & 255}.{ip & 255}/{prefix}\n"
+
+def _iter_cidrs(start, end):
+    while start <= end:
+        # start 的对齐允许的最大块 与 剩余长度允许的最大块，取小者
+        max_block = (start & -start).bit_length() - 1 if start else 32
+        span = (end - start + 1).bit_length() - 1
+        n = min(max_block, span)
+        yield _fmt_cidr(start, 32 - n)
+        start += 1 << n
+
 class QQWryParser:
-    def __init__(self, filename):
+    def __init__(self, filename, quiet=False):
         self.filename = filename
-        
-        # 检查数据库是否存在，不存在则下载
-        if not os.path.exists(filename):
-            print(f"[Info] 正在下载数据库: {QQWRY_URL}")
-            try:
-                r = requests.get(QQWRY_URL, allow_redirects=True, stream=True)
-                r.raise_for_status()
-                with open(filename, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        f.write(chunk)
-                print("[Info] 下载完成")
-            except Exception as e:
-                print(f"[Error] 下载失败: {e}")
-                raise
-
-        # 读取数据库内容到内存
-        with open(self.filename, 'rb') as f:
-            self.data = f.read()
-        
+        self.quiet = quiet
+
+        # 检查/更新数据库（worker 进程直接复用父进程准备好的文件）
+        if not quiet:
+            self._ensure_database()
+
+        # 通过 mmap 映射数据库文件，由操作系统页缓存按需加载，
+        # 避免把整个文件复制进进程内存；切片/索引/find 用法与 bytes 一致
+        self._fp = open(self.filename, 'rb')
+        self._mm = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data = self._mm
+        atexit.register(self.close)
+
+        # 地址解析缓存：QQWry 大量记录通过模式 1/2 指针复用同一位置串，
+        # 按偏移缓存结果可以省掉重复的指针链遍历和 GBK 解码
+        self._addr_cache = {}
+        self._area_cache = {}
+
+        # 关键词匹配自动机
+        self._automaton = _build_automaton()
+
         # 解析头部信息
         self.first_index = struct.unpack('<I', self.data[:4])[0]
         self.last_index = struct.unpack('<I', self.data[4:8])[0]
         self.count = (self.last_index - self.first_index) // 7 + 1
-        print(f"[Info] 数据库加载成功，共 {self.count} 条记录")
+        if not self.quiet:
+            print(f"[Info] 数据库加载成功，共 {self.count} 条记录")
+
+    # --------------------------------------------------
+    # 下载/更新数据库文件
+    # 记录服务端 ETag，下次运行带 If-None-Match 做条件请求，
+    # 数据库没变化时 (304) 跳过整个 ~10MB 下载
+    # --------------------------------------------------
+    def _ensure_database(self):
+        etag_file = self.filename + '.etag'
+        headers = {}
+        if os.path.exists(self.filename):
+            if not os.path.exists(etag_file):
+                # 本地已有文件但没有 ETag 记录，维持原有行为不重复下载
+                return
+            with open(etag_file, 'r', encoding='utf-8') as f:
+                etag = f.read().strip()
+            if etag:
+                headers['If-None-Match'] = etag
+
+        print(f"[Info] 正在下载数据库: {QQWRY_URL}")
+        try:
+            r = requests.get(QQWRY_URL, allow_redirects=True, stream=True,
+                             headers=headers)
+            if r.status_code == 304:
+                print("[Info] 数据库未变化 (304)，使用本地文件")
+                return
+            r.raise_for_status()
+            # 先写临时文件，下载完整后再原子替换正式文件，
+            # 传输中断时不会破坏本地已有的完好数据库
+            tmp_file = self.filename + '.tmp'
+            try:
+                # 大块流式拷贝，避免 8KB 级的 Python 循环
+                r.raw.decode_content = True
+                with open(tmp_file, 'wb') as f:
+                    shutil.copyfileobj(r.raw, f, length=1 << 20)
+                os.replace(tmp_file, self.filename)
+            finally:
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+            # 替换成功后才记录新 ETag，保证 ETag 始终对应现有文件
+            new_etag = r.headers.get('ETag', '')
+            if new_etag:
+                with open(etag_file, 'w', encoding='utf-8') as f:
+                    f.write(new_etag)
+            print("[Info] 下载完成")
+        except Exception as e:
+            if os.path.exists(self.filename):
+                # 条件更新失败但本地有可用文件，降级使用本地数据
+                print(f"[Warn] 数据库更新失败，使用本地文件: {e}")
+                return
+            print(f"[Error] 下载失败: {e}")
+            raise
+
+    # --------------------------------------------------
+    # 释放 mmap 映射和底层文件句柄
+    # --------------------------------------------------
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
 
     # --------------------------------------------------
     # 内部辅助函数：读取 3 字节整数
@@ -70,161 +190,276 @@ class QQWryParser:
         return struct.unpack('<I', self.data[offset:offset+3] + b'\x00')[0]
 
     # --------------------------------------------------
-    # 内部辅助函数：读取字符串 (GBK 编码)
+    # 内部辅助函数：读取 C 字符串的原始 GBK 字节
+    # 匹配在字节上进行，无需解码
     # --------------------------------------------------
-    def _get_string(self, offset):
+    def _get_string_bytes(self, offset):
         end = self.data.find(b'\x00', offset)
-        try:
-            return self.data[offset:end].decode('gbk', errors='replace')
-        except:
-            return ""
+        return bytes(self.data[offset:end])
 
     # --------------------------------------------------
     # 内部辅助函数：获取区域信息（处理重定向模式）
     # --------------------------------------------------
     def _get_area_addr(self, offset):
-        mode = self.data[offset]
-        if mode == 1 or mode == 2:
-            next_offset = self._get_long3(offset + 1)
-            if next_offset == 0: return ""
-            return self._get_area_addr(next_offset)
-        else:
-            return self._get_string(offset)
+        cached = self._area_cache.get(offset)
+        if cached is not None:
+            return cached
+        entry_offset = offset
+        # 迭代跟随模式 1/2 重定向，省掉热路径上的递归调用开销
+        while True:
+            mode = self.data[offset]
+            if mode == 1 or mode == 2:
+                offset = self._get_long3(offset + 1)
+                if offset == 0:
+                    result = b""
+                    break
+                continue
+            result = self._get_string_bytes(offset)
+            break
+        self._area_cache[entry_offset] = result
+        return result
 
     # --------------------------------------------------
     # 内部辅助函数：获取完整地址信息
     # --------------------------------------------------
     def _get_addr(self, offset):
+        cached = self._addr_cache.get(offset)
+        if cached is not None:
+            return cached
+        entry_offset = offset
         try:
-            mode = self.data[offset]
-            if mode == 1:
-                seek_offset = self._get_long3(offset + 1)
-                return self._get_addr(seek_offset)
-            elif mode == 2:
-                seek_offset = self._get_long3(offset + 1)
-                country = self._get_string(seek_offset)
-                area = self._get_area_addr(offset + 4)
-            else:
-                country = self._get_string(offset)
-                area = self._get_area_addr(offset + len(country.encode('gbk')) + 1)
-            return f"{country} {area}"
+            # 迭代跟随模式 1 重定向，到达终端记录后一次性取出国家/区域
+            while True:
+                mode = self.data[offset]
+                if mode == 1:
+                    offset = self._get_long3(offset + 1)
+                    continue
+                if mode == 2:
+                    seek_offset = self._get_long3(offset + 1)
+                    country = self._get_string_bytes(seek_offset)
+                    area = self._get_area_addr(offset + 4)
+                else:
+                    country = self._get_string_bytes(offset)
+                    area = self._get_area_addr(offset + len(country) + 1)
+                result = country + b" " + area
+                break
         except:
-            return ""
+            result = b""
+        self._addr_cache[entry_offset] = result
+        return result
+
+    # --------------------------------------------------
+    # 内部辅助函数：批量解析 7 字节索引表
+    # 用 NumPy 一次性解出所有 start_ip 和 record_offset，
+    # 避免在 Python 循环里重复调用 struct.unpack
+    # --------------------------------------------------
+    def _parse_index(self):
+        raw = np.frombuffer(self.data, dtype=np.uint8,
+                            count=self.count * 7, offset=self.first_index)
+        view = raw.reshape(self.count, 7)
+        # 前 4 字节是起始 IP (小端 u32)
+        start_ips = np.ascontiguousarray(view[:, :4]).view('<u4').ravel()
+        # 后 3 字节是记录偏移 (小端 u24)
+        record_offsets = (view[:, 4].astype(np.uint32)
+                          | (view[:, 5].astype(np.uint32) << 8)
+                          | (view[:, 6].astype(np.uint32) << 16))
+        return start_ips, record_offsets
 
     # --------------------------------------------------
     # 合并连续 IP 段的逻辑
     # --------------------------------------------------
-    def _merge_ranges(self, raw_ranges):
-        if not raw_ranges: return []
-        # 按起始 IP 排序
-        raw_ranges.sort(key=lambda x: x[0])
-        merged = []
-        curr_s, curr_e = raw_ranges[0]
-        
-        for next_s, next_e in raw_ranges[1:]:
-            # 如果下一段的开始 <= 当前段结束 + 1，则合并
-            if next_s <= curr_e + 1:
-                curr_e = max(curr_e, next_e)
-            else:
-                merged.append((curr_s, curr_e))
-                curr_s, curr_e = next_s, next_e
-        merged.append((curr_s, curr_e))
-        return merged
-
-    # --------------------------------------------------
-    # 主运行逻辑
+    def _merge_ranges(self, starts, ends):
+        if not starts: return []
+        # array.array 的缓冲区可被 NumPy 零拷贝接管；
+        # 转 int64 避免 uint32 在 "+1" 比较时溢出
+        s = np.frombuffer(starts, dtype=np.uint32).astype(np.int64)
+        e = np.frombuffer(ends, dtype=np.uint32).astype(np.int64)
+        # 扫描按索引表顺序收集，而索引表本身按起始 IP 有序，
+        # 所以这里通常已经排好序；用 O(n) 单调性检查代替重新排序
+        if len(s) > 1 and not (s[1:] >= s[:-1]).all():
+            order = np.argsort(s, kind='stable')
+            s = s[order]
+            e = e[order]
+        # 排序后做一次向量化扫描：
+        # 某段的开始 > 之前最大结束 + 1 时开启新的合并组
+        cmax = np.maximum.accumulate(e)
+        breaks = np.flatnonzero(s[1:] > cmax[:-1] + 1) + 1
+        group_starts = np.concatenate(([0], breaks))
+        group_ends = np.concatenate((breaks - 1, [len(s) - 1]))
+        return list(zip(s[group_starts].tolist(), cmax[group_ends].tolist()))
+
+    # --------------------------------------------------
+    # 扫描阶段：遍历一次全库，完成分类
+    # 所有输出形式都从这一次遍历的结果产出，
+    # 不再为每种输出各扫一遍数据库
     # --------------------------------------------------
-    def run(self):
-        # 初始化结果字典: results[省份拼音][运营商代码] = [ranges]
+    def _scan(self):
+        procs = os.cpu_count() or 1
+        if procs <= 1 or self.count < procs:
+            return self._scan_range(0, self.count)
+
+        # 按索引区间切片，交给各进程并行扫描；
+        # 各 worker mmap 同一文件，内核层面共享物理页
+        step = -(-self.count // procs)
+        shards = [(lo, min(lo + step, self.count))
+                  for lo in range(0, self.count, step)]
+        print(f"[Info] 使用 {procs} 个进程并行扫描，共 {len(shards)} 个分片")
+        with multiprocessing.Pool(procs, initializer=_init_worker,
+                                  initargs=(self.filename,)) as pool:
+            parts = pool.map(_scan_shard, shards)
+        return _merge_shard_results(parts)
+
+    # --------------------------------------------------
+    # 扫描索引区间 [lo, hi)，返回该区间的分类结果
+    # --------------------------------------------------
+    def _scan_range(self, lo, hi):
+        # 初始化结果字典: results[省份拼音][运营商代码] = (starts, ends)
+        # 用两个 array.array('I') 存 u32 对，比列表套元组省约 8 倍内存
         results = {}
         for p_code in PROVINCES.values():
-            results[p_code] = {isp_code: [] for isp_code in ISPS.values()}
-        
-        print("[Info] 开始全库扫描与分类...")
-        
-        # 遍历所有记录
-        for i in range(self.count):
-            if i % 200000 == 0 and i > 0:
-                print(f"  - 进度: {i}/{self.count}")
-                
-            idx_offset = self.first_index + i * 7
-            start_ip = struct.unpack('<I', self.data[idx_offset:idx_offset+4])[0]
-            record_offset = self._get_long3(idx_offset + 4)
-            end_ip = struct.unpack('<I', self.data[record_offset:record_offset+4])[0]
-            
-            location_str = self._get_addr(record_offset + 4)
-            
-            # 1. 匹配运营商
-            detected_isp_code = None
-            for isp_cn, isp_code in ISPS.items():
-                if isp_cn in location_str:
-                    detected_isp_code = isp_code
-                    break
-            
-            # 如果没有匹配到指定运营商，跳过
-            if not detected_isp_code:
+            results[p_code] = {isp_code: (array.array('I'), array.array('I'))
+                               for isp_code in ISPS.values()}
+
+        # 批量解析索引表，循环内只做数组取值
+        start_ips, record_offsets = self._parse_index()
+
+        # QQWry 会把多条索引指向同一条记录，先去重，
+        # 每个唯一 record_offset 只做一次地址解析与关键词分类
+        unique_offsets, inverse = np.unique(record_offsets[lo:hi],
+                                            return_inverse=True)
+
+        # 同一条记录的 end_ip 也相同：按唯一偏移向量化批量取出
+        data_u8 = np.frombuffer(self.data, dtype=np.uint8)
+        gather = unique_offsets.astype(np.int64)[:, None] + np.arange(4)
+        unique_end_ips = np.ascontiguousarray(data_u8[gather]).view('<u4').ravel()
+
+        # 每个唯一记录归入哪个 (省份, 运营商) 桶，-1 表示不保留
+        bucket_of_unique = np.full(len(unique_offsets), -1, dtype=np.int32)
+        for j, record_offset in enumerate(unique_offsets.tolist()):
+            if not self.quiet and j % 100000 == 0 and j > 0:
+                print(f"  - 进度: {j}/{len(unique_offsets)} (唯一记录)")
+
+            location_bytes = self._get_addr(record_offset + 4)
+
+            # 粗筛：不含任何运营商关键词的记录直接跳过
+            if not any(kb in location_bytes for kb in _ISP_GBK):
                 continue
 
-            # 2. 匹配省份
-            detected_prov_code = None
-            for prov_cn, prov_code in PROVINCES.items():
-                if prov_cn in location_str:
-                    detected_prov_code = prov_code
-                    break
-            
-            # 只有当省份和运营商都匹配时才存入
-            if detected_prov_code:
-                results[detected_prov_code][detected_isp_code].append((start_ip, end_ip))
+            # 一次扫描同时收集运营商与省份命中
+            isp_hits = set()
+            prov_hits = set()
+            for _, (kind, code) in self._automaton.iter(location_bytes.decode('latin-1')):
+                if kind == 'isp':
+                    isp_hits.add(code)
+                else:
+                    prov_hits.add(code)
 
-        print("[Info] 扫描完成，正在合并网段并写入单一文件...")
-        
+            # 只有当省份和运营商都匹配时才保留
+            if isp_hits and prov_hits:
+                bucket_of_unique[j] = _BUCKET_INDEX[
+                    (min(prov_hits, key=_PROV_ORDER.get),
+                     min(isp_hits, key=_ISP_ORDER.get))]
+
+        # 向量化回填：按桶一次性切出该桶所有记录的 start/end，
+        # 逐条 Python 循环下沉为 NumPy 的 C 级掩码运算
+        rec_buckets = bucket_of_unique[inverse]
+        rec_end_ips = unique_end_ips[inverse]
+        sub_start_ips = start_ips[lo:hi]
+        for b in np.unique(rec_buckets).tolist():
+            if b < 0:
+                continue
+            mask = rec_buckets == b
+            prov_code, isp_code = _BUCKETS[b]
+            starts, ends = results[prov_code][isp_code]
+            starts.frombytes(sub_start_ips[mask].tobytes())
+            ends.frombytes(rec_end_ips[mask].tobytes())
+
+        return results
+
+    # --------------------------------------------------
+    # 输出阶段：把分类结果合并成网段并写入单一文件
+    # --------------------------------------------------
+    def _emit_single_file(self, results):
         current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-        # 打开单一文件进行写入
-        with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
-            f.write(f"# Generated by script at {current_time}\n")
-            f.write("# Format: IP_CIDR # Comment\n\n")
-
-            # 按照 PROVINCES 的顺序遍历，保证输出有序
-            for prov_cn, prov_code in PROVINCES.items():
-                
-                # 检查该省份是否有数据
-                prov_has_data = any(len(results[prov_code][isp]) > 0 for isp in ISPS.values())
-                if not prov_has_data:
+        # 先在内存里拼好所有行，最后一次性写入，
+        # 避免几万次小块 write 和逐次的文本编码开销
+        lines = []
+        lines.append(f"# Generated by script at {current_time}\n")
+        lines.append("# Format: IP_CIDR # Comment\n\n")
+
+        # 按照 PROVINCES 的顺序遍历，保证输出有序
+        for prov_cn, prov_code in PROVINCES.items():
+
+            # 检查该省份是否有数据
+            prov_has_data = any(len(results[prov_code][isp][0]) > 0 for isp in ISPS.values())
+            if not prov_has_data:
+                continue
+
+            # 写入省份大标题（使用 # 注释格式）
+            lines.append(f"# {'='*50}\n")
+            lines.append(f"# 省份区域: {prov_cn} ({prov_code})\n")
+            lines.append(f"# {'='*50}\n")
+
+            for isp_cn, isp_code in ISPS.items():
+                starts, ends = results[prov_code][isp_code]
+                if not starts:
                     continue
-                
-                # 写入省份大标题（使用 # 注释格式）
-                f.write(f"# {'='*50}\n")
-                f.write(f"# 省份区域: {prov_cn} ({prov_code})\n")
-                f.write(f"# {'='*50}\n")
-
-                for isp_cn, isp_code in ISPS.items():
-                    ranges = results[prov_code][isp_code]
-                    if not ranges:
-                        continue
-
-                    # 合并 IP 段
-                    merged = self._merge_ranges(ranges)
-                    
-                    # 写入分组注释头
-                    f.write(f"\n# === [{prov_cn}] {isp_cn} | 规则数: {len(merged)} ===\n")
-                    
-                    for s, e in merged:
-                        try:
-                            s_addr = ipaddress.IPv4Address(s)
-                            e_addr = ipaddress.IPv4Address(e)
-                            # 转换为 CIDR 格式并写入
-                            for net in ipaddress.summarize_address_range(s_addr, e_addr):
-                                f.write(f"{str(net)}\n")
-                        except Exception as e:
-                            # 极少数畸形IP段跳过
-                            pass
-                
-                # 省份之间空一行
-                f.write("\n")
+
+                # 合并 IP 段
+                merged = self._merge_ranges(starts, ends)
+
+                # 写入分组注释头
+                lines.append(f"\n# === [{prov_cn}] {isp_cn} | 规则数: {len(merged)} ===\n")
+
+                for s, e in merged:
+                    # 转换为 CIDR 格式（行内已带换行）
+                    lines.extend(_iter_cidrs(s, e))
+
+            # 省份之间空一行
+            lines.append("\n")
+
+        # 单次二进制写入（内容只在注释里含中文，统一按 UTF-8 编码）
+        with open(OUTPUT_FILE, 'wb') as f:
+            f.write(''.join(lines).encode('utf-8'))
 
         print(f"[Success] 所有数据已合并写入: {OUTPUT_FILE}")
 
+    # --------------------------------------------------
+    # 主运行逻辑：一次扫描 + 各种输出
+    # --------------------------------------------------
+    def run(self):
+        print("[Info] 开始全库扫描与分类...")
+        results = self._scan()
+        print("[Info] 扫描完成，正在合并网段并写入单一文件...")
+        self._emit_single_file(results)
+
+# ==================================================
+# 多进程 worker：每个进程各自 mmap 数据库并扫描一个索引分片
+# ==================================================
+_WORKER = None
+
+def _init_worker(filename):
+    global _WORKER
+    _WORKER = QQWryParser(filename, quiet=True)
+
+def _scan_shard(bounds):
+    lo, hi = bounds
+    return _WORKER._scan_range(lo, hi)
+
+def _merge_shard_results(parts):
+    # 按分片顺序拼接各进程的结果，保持与单进程扫描一致的顺序
+    merged = {}
+    for p_code in PROVINCES.values():
+        merged[p_code] = {isp_code: (array.array('I'), array.array('I'))
+                          for isp_code in ISPS.values()}
+    for part in parts:
+        for p_code, by_isp in part.items():
+            for isp_code, (starts, ends) in by_isp.items():
+                merged[p_code][isp_code][0].extend(starts)
+                merged[p_code][isp_code][1].extend(ends)
+    return merged
+
 # ==================================================
 # 程序入口
 # ==================================================